@@ -8,10 +8,20 @@
 #Please use .csv format for marker import
 
 import os
+import re
+import codecs
+import locale
+import tempfile
 import Metashape
-import glob
 import csv
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
 from PySide2 import QtGui, QtCore, QtWidgets
 
 
@@ -34,16 +44,26 @@ parent = app.activeWindow()
 # Define the minimum required version
 MIN_REQUIRED_VERSION = "2.0.0"
 
+# Image file extensions picked up when importing photos (compared lowercase)
+_IMG_EXTS = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+
+# Extract the major, minor, and patch numbers from a version string
+def _parse_version(version):
+    try:
+        return tuple(int(part) for part in version.split('.')[:3])
+    except ValueError:
+        # Tolerate build or pre-release suffixes on the version string
+        match = re.match(r'(\d+)\.(\d+)\.(\d+)', version)
+        return tuple(int(part) for part in match.groups()) if match else (0, 0, 0)
+
+# Parse the current and required versions once when the script is loaded
+_CURRENT_VERSION = _parse_version(Metashape.app.version)
+_REQUIRED_VERSION = _parse_version(MIN_REQUIRED_VERSION)
+
 def check_metashape_version():
-    # Get the current version of Metashape
-    current_version = Metashape.app.version
-    # Extract the major, minor, and patch numbers
-    major, minor, patch = map(int, current_version.split('.')[:3])
-    required_major, required_minor, required_patch = map(int, MIN_REQUIRED_VERSION.split('.'))
-    
     # Check if the current version is equal to or higher than the required version
-    if (major, minor, patch) < (required_major, required_minor, required_patch):
-        print(f"Your Metashape version {current_version} is not supported by this script.")
+    if _CURRENT_VERSION < _REQUIRED_VERSION:
+        print(f"Your Metashape version {Metashape.app.version} is not supported by this script.")
         print(f"Please upgrade to Metashape version {MIN_REQUIRED_VERSION} or later.")
         return False
     return True
@@ -61,10 +81,14 @@ def add_altitude():
     print("Script started...")
     chunk = doc.chunk
 
-    for camera in chunk.cameras:
-        if camera.reference.location:
-            coord = camera.reference.location
-            camera.reference.location = Metashape.Vector([coord.x, coord.y, coord.z + alt])
+    # Add the altitude to all z values at once, then write back reusing one Vector
+    cameras = [camera for camera in chunk.cameras if camera.reference.location]
+    coords = np.array([tuple(camera.reference.location) for camera in cameras], dtype=np.float64).reshape(-1, 3)
+    coords[:, 2] += alt
+    location = Metashape.Vector([0.0, 0.0, 0.0])
+    for camera, (x, y, z) in zip(cameras, coords):
+        location.x, location.y, location.z = x, y, z
+        camera.reference.location = location
 
     print("Script finished!")
 
@@ -81,22 +105,32 @@ def read_DJI_relative_altitude():
     print("Script started...")
     chunk = doc.chunk
 
-    for camera in chunk.cameras:
-        if not camera.type == Metashape.Camera.Type.Regular: #skip camera track, if any
-            continue
-        if not camera.reference.location:
-            continue
-        if "DJI/RelativeAltitude" in camera.photo.meta.keys():
-            z = float(camera.photo.meta["DJI/RelativeAltitude"])
-            camera.reference.location = Metashape.Vector([camera.reference.location.x, camera.reference.location.y, z])
+    for camera in _live_cameras(chunk):
+        meta = camera.photo.meta
+        if "DJI/RelativeAltitude" in meta.keys():
+            z = float(meta["DJI/RelativeAltitude"])
+            # Only write the reference when the altitude actually changes
+            if camera.reference.location.z != z:
+                camera.reference.location = Metashape.Vector([camera.reference.location.x, camera.reference.location.y, z])
+
+    print("Script finished!")
 
-    print("Script finished!")    
+# Regular cameras (skipping camera tracks, if any) that have a reference location
+def _live_cameras(chunk):
+    return [camera for camera in chunk.cameras if camera.type == Metashape.Camera.Type.Regular and camera.reference.location]
 
 def open_project_folder(project_folder):
+    # Nothing to show when running headless (e.g. metashape -r script.py). Focus is not checked,
+    # Metashape is often in the background by the time a long run finishes.
+    app = QtWidgets.QApplication.instance()
+    if app is None or QtGui.QGuiApplication.platformName() in ('offscreen', 'minimal') or not app.topLevelWidgets():
+        return
+
     if os.name == 'posix':  # macOS and Linux
         subprocess.Popen(['open', project_folder])
     elif os.name == 'nt':  # Windows
-        os.startfile(project_folder)
+        # Spawn Explorer detached so Metashape does not wait for the shell to start
+        subprocess.Popen(['explorer', project_folder], creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP, close_fds=True)
         
 def get_images_folder():
     app = QtWidgets.QApplication.instance()
@@ -152,30 +186,67 @@ def import_KML():
     except Exception as e:
         print(f"Error importing KML file: {e}")
 
+# Normalize a file path so the same image compares equal however it was spelled
+def _normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+# List a single folder once, returning its images and its subfolders
+def _scan_folder(folder):
+    images, subfolders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                # Skip hidden entries, e.g. macOS ._DJI_0001.JPG resource forks and .Trashes
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    subfolders.append(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(_IMG_EXTS):
+                    images.append(entry.path)
+    except OSError as e:
+        print(f"Error scanning folder {folder}: {e}")
+    return images, subfolders
+
+# Collect the images below a folder, scanning every subfolder at any depth on the thread pool
+def _scan_images(images_folder, max_workers=8):
+    images = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(_scan_folder, images_folder)]
+        while pending:
+            found_images, subfolders = pending.pop(0).result()
+            images.extend(found_images)
+            pending.extend(executor.submit(_scan_folder, subfolder) for subfolder in subfolders)
+    return images
+
 # Define the function to import images
-def import_images_from_folders(images_folder):
+def import_images_from_folders(images_folder, chunk=None):
     print("Importing images from:", images_folder)
+    images = []
     try:
-        chunk = create_or_get_chunk()
+        if chunk is None:
+            chunk = create_or_get_chunk()
         if chunk:
-            extensions = ['jpg', 'tif', 'png']
-            images = []
-            for ext in extensions:
-                # Constructing the file pattern for glob
-                images_pattern = os.path.join(images_folder, '**', f'*.{ext}')
-                found_images = glob.glob(images_pattern, recursive=True)
-                images.extend(found_images)
-
-            if images:
-                chunk.addPhotos(images)
-                print("Images imported successfully.")
+            # Each folder (e.g. DCIM, 100MEDIA, 101MEDIA) is listed once, on its own thread
+            images = _scan_images(images_folder)
+
+            # Skip images that are already in the chunk, e.g. when rerunning the workflow
+            existing = {_normalize_path(camera.photo.path) for camera in chunk.cameras if camera.photo}
+            new_images = [path for path in images if _normalize_path(path) not in existing]
+
+            if new_images:
+                chunk.addPhotos(new_images, load_reference=True, load_xmp_calibration=True, load_xmp_orientation=True, load_xmp_accuracy=True, load_xmp_antenna=True)
+                print(f"{len(new_images)} image(s) imported successfully.")
+            elif images:
+                print("All images are already in the chunk, nothing to import.")
             else:
                 print("No images found to import.")
     except Exception as e:
         print(f"Error importing images: {e}")
-        
-# Define create or get existing chunk        
+    return images
+
+# Define create or get existing chunk
 def create_or_get_chunk():
+    doc = Metashape.app.document
     try:
         if not doc.chunks:
             chunk = doc.addChunk()
@@ -188,9 +259,17 @@ def create_or_get_chunk():
         print(f"Error creating/getting chunk: {e}")
         return None
  
+# Check whether two coordinate systems are the same, so no-op transforms can be skipped
+def _same_crs(crs_a, crs_b):
+    if crs_a is None or crs_b is None:
+        return crs_a is crs_b
+    return crs_a == crs_b or crs_a.wkt == crs_b.wkt
+
 # Define the function to convert coordinates of cameras and markers
 def convert_reference(chunk, target_crs):
     original_crs = chunk.crs
+    if _same_crs(original_crs, target_crs):
+        return
     for camera in chunk.cameras:
         if camera.reference.location:
             camera.reference.location = Metashape.CoordinateSystem.transform(camera.reference.location, original_crs, target_crs)
@@ -198,8 +277,30 @@ def convert_reference(chunk, target_crs):
         if marker.reference.location:
             marker.reference.location = Metashape.CoordinateSystem.transform(marker.reference.location, original_crs, target_crs)
     chunk.crs = target_crs
-    chunk.updateTransform()
     
+# Downscale values accepted by matchPhotos: 0 highest, 1 high, 2 medium, 4 low, 8 lowest
+MATCH_DOWNSCALES = (0, 1, 2, 4, 8)
+
+# Ask for the matching downscale until a supported value is given, returns None when cancelled
+def get_match_downscale():
+    while True:
+        try:
+            downscale = Metashape.app.getInt("Match downscale (1 = full resolution, 2 = half):", 1)
+        except Exception:
+            return None
+        if downscale is None:
+            return None
+        if downscale in MATCH_DOWNSCALES:
+            return downscale
+        Metashape.app.messageBox(f"Unsupported match downscale {downscale}. Please use one of {', '.join(map(str, MATCH_DOWNSCALES))}.")
+
+# Define the function to match the images, scaling the keypoint limit with sensor size on Metashape 2.1+
+def match_photos(chunk, downscale=1):
+    if _CURRENT_VERSION >= (2, 1, 0):
+        chunk.matchPhotos(downscale=downscale, generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit_per_mpx=1000, tiepoint_limit=4000)
+    else:
+        chunk.matchPhotos(downscale=downscale, generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit=40000, tiepoint_limit=4000)
+
 # Define the function to align the images
 def align_images(chunk):
     try:
@@ -221,42 +322,75 @@ def import_reference_markers(chunk):
         print("File selection cancelled.")
         return
 
+    import_path = file_path
     try:
-        # Read the file and add markers
-        with open(file_path, 'r') as file:
-            for line in file:
-                # Skip empty lines
-                if not line.strip():
-                    continue
-
-                # Split the line by comma or whitespace
-                row = line.strip().split(',')
-                if len(row) < 4:
-                    row = line.strip().split()
-
-                if len(row) != 4:
-                    print("Skipping row: Incorrect number of values. Expected 4 columns (Name, Easting, Northing, Altitude).")
-                    continue
-
-                # Parse the marker data
-                name, easting, northing, altitude = row
-                x, y, z = float(easting), float(northing), float(altitude)
-
-                # Create a marker in the chunk
-                marker = chunk.addMarker()
-                marker.label = name
-                marker.reference.location = Metashape.Vector([x, y, z])
-                marker.reference.enabled = True
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        has_bom = data.startswith(codecs.BOM_UTF8)
+        try:
+            text = data.decode('utf-8-sig')
+            is_utf8 = True
+        except UnicodeDecodeError:
+            # Not UTF-8, e.g. a CSV saved by Excel on Windows in the system code page.
+            # Assume cp1252 where the system encoding is UTF-8 itself (macOS, Linux).
+            encoding = locale.getpreferredencoding(False)
+            if codecs.lookup(encoding).name == 'utf-8':
+                encoding = 'cp1252'
+            text = data.decode(encoding, errors='replace')
+            is_utf8 = False
+
+        # Detect comma, tab or space delimited files from a sample
+        sample = text[:4096]
+        if ',' in sample:
+            delimiter = ','
+        elif '\t' in sample:
+            delimiter = '\t'
+        else:
+            delimiter = ' '
+
+        # Metashape would keep an Excel byte-order mark in the first label and reads the file as UTF-8,
+        # so import a plain UTF-8 copy when the file has a BOM or another encoding
+        if has_bom or not is_utf8:
+            handle, import_path = tempfile.mkstemp(suffix=os.path.splitext(file_path)[1])
+            with os.fdopen(handle, 'w', encoding='utf-8', newline='') as file:
+                file.write(text)
+
+        # Let Metashape parse the file and create the markers (Name, Easting, Northing, Altitude).
+        # Only markers are matched, so a GCP label can never overwrite a camera reference.
+        marker_count = len(chunk.markers)
+        chunk.importReference(path=import_path, format=Metashape.ReferenceFormatCSV, columns='nxyz', delimiter=delimiter,
+                              group_delimiters=True, crs=chunk.crs, items=Metashape.ReferenceItemsMarkers,
+                              ignore_labels=False, create_markers=True)
+        print(f"{len(chunk.markers) - marker_count} marker(s) created.")
 
         print(f"File '{os.path.basename(file_path)}' imported successfully.")
     except Exception as e:
         print(f"Error importing file: {e}")
+    finally:
+        if import_path != file_path and os.path.isfile(import_path):
+            os.remove(import_path)
 
         
+# Use every available GPU and keep the CPU from competing with them for the duration of a build,
+# restoring the user's GPU preferences afterwards
+@contextmanager
+def _all_gpus_enabled():
+    gpu_mask, cpu_enable = Metashape.app.gpu_mask, Metashape.app.cpu_enable
+    try:
+        gpu_count = len(Metashape.app.enumGPUDevices())
+        if gpu_count:
+            Metashape.app.gpu_mask = (1 << gpu_count) - 1
+            Metashape.app.cpu_enable = False
+        yield
+    finally:
+        Metashape.app.gpu_mask = gpu_mask
+        Metashape.app.cpu_enable = cpu_enable
+
 #downscale set to 8 for "low quality", original value=4:
 def generate_depth_maps(chunk):
     try:
-        chunk.buildDepthMaps(downscale=8, filter_mode=Metashape.MildFiltering) 
+        with _all_gpus_enabled():
+            chunk.buildDepthMaps(downscale=8, filter_mode=Metashape.MildFiltering) 
     except Exception as e:
         print(f"Error generating depth maps: {e}")
 
@@ -264,7 +398,8 @@ def generate_depth_maps(chunk):
 def generate_point_cloud(chunk):
     try:
         if chunk.transform.scale and chunk.transform.rotation and chunk.transform.translation:
-            chunk.buildPointCloud(point_confidence=True)
+            with _all_gpus_enabled():
+                chunk.buildPointCloud(point_confidence=True)
         else:
             print("Error: Transformation not applied. Please apply transformation first.")
     except Exception as e:
@@ -288,13 +423,11 @@ def generate_orthomosaic(chunk):
     except Exception as e:
         print(f"Error generating orthomosaic: {e}")
 
-def export_las(chunk):
+def export_las(chunk, project_dir, project_name):
     try:
         if chunk.point_cloud:
-            project_name = Metashape.app.document.path.split("/")[-1].split(".")[0]
-            output_folder = Metashape.app.document.path.rsplit("/", 1)[0]
             # Change the extension to .laz for compressed format
-            laz_output_path = os.path.join(output_folder, f'{project_name}_point_cloud.laz')
+            laz_output_path = os.path.join(project_dir, f'{project_name}_point_cloud.laz')
             # Assuming Metashape supports .laz format in the exportPointCloud method
             chunk.exportPointCloud(laz_output_path, source_data=Metashape.PointCloudData, clip_to_boundary=True)
         else:
@@ -302,25 +435,84 @@ def export_las(chunk):
     except Exception as e:
         print(f"Error exporting LAZ file: {e}")
 
-def export_orthomosaic(chunk, format='png', resolution=0.1):
+# LZW compressed, tiled BigTIFF with overviews so large orthomosaics stay small and past the 4 GB limit
+def _tiff_compression():
+    compression = Metashape.ImageCompression()
+    compression.tiff_compression = Metashape.ImageCompression.TiffCompressionLZW
+    compression.tiff_big = True
+    compression.tiff_tiled = True
+    compression.tiff_overviews = True
+    return compression
+
+def export_orthomosaic(chunk, project_dir, project_name, format='png', resolution=0.1):
     try:
         if chunk.point_cloud:
-            project_name = Metashape.app.document.path.split("/")[-1].split(".")[0]
-            output_folder = Metashape.app.document.path.rsplit("/", 1)[0]
-            ortho_output_path = os.path.join(output_folder, f'{project_name}_ortho_{int(resolution*100)}cm.{format}')
-            chunk.exportRaster(ortho_output_path, format=Metashape.RasterFormatTiles, 
-                               image_format=Metashape.ImageFormatPNG if format == 'png' else Metashape.ImageFormatTIFF,
-                               raster_transform=Metashape.RasterTransformNone, save_world=True, clip_to_boundary=True, resolution=resolution)
+            ortho_output_path = os.path.join(project_dir, f'{project_name}_ortho_{int(resolution*100)}cm.{format}')
+            if format == 'png':
+                image_options = dict(image_format=Metashape.ImageFormatPNG)
+            else:
+                image_options = dict(image_format=Metashape.ImageFormatTIFF, image_compression=_tiff_compression())
+            chunk.exportRaster(ortho_output_path, format=Metashape.RasterFormatTiles, **image_options,
+                               raster_transform=Metashape.RasterTransformNone, save_kml=False, save_world=True, save_alpha=True, clip_to_boundary=True, resolution=resolution)
+            return ortho_output_path
         else:
             print("Error: Orthomosaic not available. Please generate orthomosaic first.")
     except Exception as e:
         print(f"Error exporting orthomosaic: {e}")
+    return None
+
+# Derive a coarser orthomosaic from an already exported one by pixel averaging.
+# res and src_res are in metres like exportRaster, so the GDAL pixel size is scaled from the
+# source pixel size rather than passed directly (it would be in degrees for a geographic crs).
+def _downsample_ortho(src_tif, dst_path, res, fmt, src_res):
+    if gdal is None or not src_tif or not os.path.isfile(src_tif):
+        return False
+    try:
+        source = gdal.Open(src_tif)
+        if source is None:
+            return False
+        geotransform = source.GetGeoTransform()
+        scale = res / src_res
+        x_res, y_res = abs(geotransform[1]) * scale, abs(geotransform[5]) * scale
+
+        # Warp in memory using the alpha band as a mask so transparent pixels are not averaged into the edges
+        warped = gdal.Warp('', source, format='MEM', xRes=x_res, yRes=y_res, resampleAlg='average', srcAlpha=True, dstAlpha=True)
+        if warped is None:
+            return False
+        # PNG only supports CreateCopy, so write the result out from the in-memory dataset.
+        # No .aux.xml sidecar, the outputs should match what Metashape writes with save_world.
+        pam_enabled = gdal.GetConfigOption('GDAL_PAM_ENABLED')
+        gdal.SetConfigOption('GDAL_PAM_ENABLED', 'NO')
+        try:
+            dataset = gdal.GetDriverByName(fmt).CreateCopy(dst_path, warped, options=['WORLDFILE=YES'])
+            if dataset is None:
+                return False
+            dataset = warped = source = None  # Close the datasets to flush them to disk
+        finally:
+            gdal.SetConfigOption('GDAL_PAM_ENABLED', pam_enabled)
+
+        # GDAL names the world file .wld, Metashape uses .pgw for PNG
+        world_path = os.path.splitext(dst_path)[0] + '.wld'
+        if fmt == 'PNG' and os.path.isfile(world_path):
+            os.replace(world_path, os.path.splitext(dst_path)[0] + '.pgw')
+        return True
+    except Exception as e:
+        print(f"Error downsampling orthomosaic: {e}")
+        return False
 
-def export_report(chunk):
+# Export the 4cm TIFF once and derive the 20cm and 30cm PNGs from it
+def export_orthomosaics(chunk, project_dir, project_name):
+    tif_resolution = 0.04
+    tif_path = export_orthomosaic(chunk, project_dir, project_name, format='tif', resolution=tif_resolution)
+    for resolution in (0.2, 0.3):
+        png_path = os.path.join(project_dir, f'{project_name}_ortho_{int(resolution*100)}cm.png')
+        if not _downsample_ortho(tif_path, png_path, resolution, 'PNG', tif_resolution):
+            # GDAL not available or failed, render from Metashape instead
+            export_orthomosaic(chunk, project_dir, project_name, format='png', resolution=resolution)
+
+def export_report(chunk, project_dir, project_name):
     try:
-        project_name = Metashape.app.document.path.split("/")[-1].split(".")[0]
-        output_folder = Metashape.app.document.path.rsplit("/", 1)[0]
-        report_output_path = os.path.join(output_folder, f'{project_name}_report.pdf')
+        report_output_path = os.path.join(project_dir, f'{project_name}_report.pdf')
         chunk.exportReport(report_output_path)
     except Exception as e:
         print(f"Error exporting report: {e}")
@@ -330,19 +522,23 @@ def export_report(chunk):
 def workflow_DJI():
     global parent
 
-    # Get the Metashape document
+    # Get the Metashape document and its active chunk once
     doc = Metashape.app.document
+    chunk = doc.chunk if doc.chunks else None
 
     # Check if the document has any chunks
-    if not doc.chunks:
+    if chunk is None:
         print("No active chunks in the Metashape document.")
         return       
 
-    # Now it's safe to get the project path
-    project_path = doc.path
-   
     if not check_metashape_version():
         return  # Stop execution if the version check fails 
+
+    # Ask for the image matching downscale (1 = full resolution, 2 = half)
+    match_downscale = get_match_downscale()
+    if match_downscale is None:
+        print("Match downscale selection cancelled.")
+        return
     
     # Get the images folder from the user
     images_folder = get_images_folder()
@@ -353,7 +549,7 @@ def workflow_DJI():
     print("Beginning start-up sequence")
 
     # Call the function to import images from the selected folder
-    import_images_from_folders(images_folder)
+    image_list = import_images_from_folders(images_folder, chunk)
 
     print("Checking save filename")
     project_path = Metashape.app.getSaveFileName("Specify project name and location for saving:")
@@ -368,57 +564,37 @@ def workflow_DJI():
 
     # Use the existing chunk
     doc.save(path=project_path)
-    chunk = doc.chunk  # Assuming there is always an existing chunk when the script is run
 
-    print("Adding photos")
+    print("Processing cameras")
     try:
-        image_list = [
-            os.path.join(images_folder, path)
-            for path in os.listdir(images_folder)
-            if path.lower().endswith(("jpg", "jpeg", "tif", "png", "JPG", "JPEG", "TIF", ""))
-        ]
-
         if not image_list:
             print("No images found to add.")
             return
 
-        chunk.addPhotos(image_list, load_reference=True, load_xmp_calibration=True, load_xmp_orientation=True, load_xmp_accuracy=True, load_xmp_antenna=True)
-
-        # Process cameras
-        for camera in chunk.cameras:
-            if camera.reference.location:
-                coord = camera.reference.location
-                camera.reference.location = Metashape.CoordinateSystem.transform(coord, chunk.crs, crs)
-        chunk.crs = crs     
+        # Process cameras, skipped by convert_reference when the chunk is already in the selected crs
+        convert_reference(chunk, crs)
                 
     except Exception as e:
         print(f"Error in adding photos or processing cameras: {e}")      
     
     # Convert reference crs
-    if not doc.chunks:
-        Metashape.app.messageBox("No chunk is available.")
+    target_crs = Metashape.app.getCoordinateSystem("Select Target Coordinate System", chunk.crs)
+    if target_crs:
+        convert_reference(chunk, target_crs)
+        print("Coordinate system conversion completed.")
     else:
-        chunk = doc.chunk
-        target_crs = Metashape.app.getCoordinateSystem("Select Target Coordinate System", chunk.crs)
-        if target_crs:
-            convert_reference(chunk, target_crs)
-            print("Coordinate system conversion completed.")
-        else:
-            print("Coordinate system selection cancelled.")
+        print("Coordinate system selection cancelled.")
            
     
     print ("Align Photos")
     #chunk.crs = crs
-    chunk.matchPhotos(downscale=1, generic_preselection=True, reference_preselection=True,filter_mask=False, keypoint_limit=40000, tiepoint_limit=4000)
+    match_photos(chunk, match_downscale)
     chunk.alignCameras(adaptive_fitting=False)
-        
-    #document save
-    doc.save()
 
     #Optimize Cameras
     chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_p3=False,fit_p4=False, fit_corrections=True, tiepoint_covariance=True)
 
-    #Set Coordinate System
+    #Set Coordinate System once all reference edits are done, then save before the dense stages
     chunk.updateTransform()
     doc.save()
 
@@ -439,28 +615,21 @@ def workflow_DJI():
     #document save
     doc.save()
         
-    # Construct the base name for output files using project_path
-    base_output_name = os.path.splitext(os.path.basename(project_path))[0]   
-        
-    # Export results
-
-    # Export functions using project_folder for saving the files
-    # Export results
-    export_las(chunk)  # Pass only the chunk as the function constructs the file path internally
-    export_orthomosaic(chunk, format='png', resolution=0.2)
-    export_orthomosaic(chunk, format='tif', resolution=0.04)
-    export_orthomosaic(chunk, format='png', resolution=0.3)
-    export_report(chunk)
-
-    # Determine the project folder
+    # Determine the project folder and the base name for output files
     if doc.path:  # Check if the project is saved
-        project_folder = os.path.dirname(doc.path)
+        project_dir = os.path.dirname(doc.path)
+        project_name = os.path.splitext(os.path.basename(doc.path))[0]
     else:
         print("Project not saved. Please save the project first.")
         return 
 
-    print(f"Processing finished, results saved to {project_folder}.")
-    open_project_folder(project_folder)
+    # Export results
+    export_las(chunk, project_dir, project_name)
+    export_orthomosaics(chunk, project_dir, project_name)
+    export_report(chunk, project_dir, project_name)
+
+    print(f"Processing finished, results saved to {project_dir}.")
+    open_project_folder(project_dir)
     
     
        
@@ -468,19 +637,23 @@ def workflow_DJI():
 def workflow_DJI_step1():
     global parent
 
-    # Get the Metashape document
+    # Get the Metashape document and its active chunk once
     doc = Metashape.app.document
+    chunk = doc.chunk if doc.chunks else None
 
     # Check if the document has any chunks
-    if not doc.chunks:
+    if chunk is None:
         print("No active chunks in the Metashape document.")
         return
 
-    # Now it's safe to get the project path
-    project_path = doc.path
-    
     if not check_metashape_version():
         return  # Stop execution if the version check fails 
+
+    # Ask for the image matching downscale (1 = full resolution, 2 = half)
+    match_downscale = get_match_downscale()
+    if match_downscale is None:
+        print("Match downscale selection cancelled.")
+        return
     
     # Get the images folder from the user
     images_folder = get_images_folder()
@@ -491,7 +664,7 @@ def workflow_DJI_step1():
     print("Beginning start-up sequence")
 
     # Call the function to import images from the selected folder
-    import_images_from_folders(images_folder)
+    image_list = import_images_from_folders(images_folder, chunk)
 
     print("Checking save filename")
     project_path = Metashape.app.getSaveFileName("Specify project name and location for saving:")
@@ -506,43 +679,26 @@ def workflow_DJI_step1():
 
     # Use the existing chunk
     doc.save(path=project_path)
-    chunk = doc.chunk  # Assuming there is always an existing chunk when the script is run
 
-    print("Adding photos")
+    print("Processing cameras")
     try:
-        image_list = [
-            os.path.join(images_folder, path)
-            for path in os.listdir(images_folder)
-            if path.lower().endswith(("jpg", "jpeg", "tif", "png", "JPG", "JPEG", "TIF", ""))
-        ]
-
         if not image_list:
             print("No images found to add.")
             return
 
-        chunk.addPhotos(image_list, load_reference=True, load_xmp_calibration=True, load_xmp_orientation=True, load_xmp_accuracy=True, load_xmp_antenna=True)
-
-        # Process cameras
-        for camera in chunk.cameras:
-            if camera.reference.location:
-                coord = camera.reference.location
-                camera.reference.location = Metashape.CoordinateSystem.transform(coord, chunk.crs, crs)
-        chunk.crs = crs     
+        # Process cameras, skipped by convert_reference when the chunk is already in the selected crs
+        convert_reference(chunk, crs)
                 
     except Exception as e:
         print(f"Error in adding photos or processing cameras: {e}")      
     
     # Convert reference crs
-    if not doc.chunks:
-        Metashape.app.messageBox("No chunk is available.")
+    target_crs = Metashape.app.getCoordinateSystem("Select Target Coordinate System", chunk.crs)
+    if target_crs:
+        convert_reference(chunk, target_crs)
+        print("Coordinate system conversion completed.")
     else:
-        chunk = doc.chunk
-        target_crs = Metashape.app.getCoordinateSystem("Select Target Coordinate System", chunk.crs)
-        if target_crs:
-            convert_reference(chunk, target_crs)
-            print("Coordinate system conversion completed.")
-        else:
-            print("Coordinate system selection cancelled.")
+        print("Coordinate system selection cancelled.")
              
    
     # Call the function to import markers
@@ -550,16 +706,13 @@ def workflow_DJI_step1():
     
     print ("Align Photos")
     #chunk.crs = crs
-    chunk.matchPhotos(downscale=1, generic_preselection=True, reference_preselection=True,filter_mask=False, keypoint_limit=40000, tiepoint_limit=4000)
+    match_photos(chunk, match_downscale)
     chunk.alignCameras(adaptive_fitting=False)
-        
-    #document save
-    doc.save()
 
     #Optimize Cameras
     #chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_p3=False,fit_p4=False, fit_corrections=True, tiepoint_covariance=True)
 
-    #Set Coordinate System
+    #Set Coordinate System once the reference and markers are in place, then save for step 2
     chunk.updateTransform()
     doc.save()
 
@@ -575,28 +728,24 @@ def workflow_DJI_step1():
 def workflow_DJI_step2():
     global parent
     
-    # Get the Metashape document
+    # Get the Metashape document and its active chunk once
     doc = Metashape.app.document
+    chunk = doc.chunk if doc.chunks else None
     
-     # Determine the project folder
+     # Determine the project folder and the base name for output files
     if doc.path:  # Check if the project is saved
-        project_folder = os.path.dirname(doc.path)
+        project_dir = os.path.dirname(doc.path)
+        project_name = os.path.splitext(os.path.basename(doc.path))[0]
     else:
         print("Project not saved. Please save the project first.")
         return
         
     # Check if there are any chunks in the document
-    if len(doc.chunks) > 0:
-        chunk = doc.chunks[0]  # Access the first chunk
-        print("Workflow Step 2:\nStarting processing...")
-        # Proceed with operations on the chunk
-    else:
+    if chunk is None:
         print("No chunks found in the document")
-        # Handle the situation where no chunks are available
+        return
+    print("Workflow Step 2:\nStarting processing...")
 
-    # Now it's safe to get the project path
-    project_path = doc.path
-    
     # Optimize Cameras
     chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_p3=False,fit_p4=False)
 
@@ -622,21 +771,13 @@ def workflow_DJI_step2():
     # Document save
     doc.save()
         
-    # Construct the base name for output files using project_path
-    base_output_name = os.path.splitext(os.path.basename(project_path))[0]   
-        
     # Export results
+    export_las(chunk, project_dir, project_name)
+    export_orthomosaics(chunk, project_dir, project_name)
+    export_report(chunk, project_dir, project_name)
 
-    # Export functions using project_folder for saving the files
-    # Export results
-    export_las(chunk)  # Pass only the chunk as the function constructs the file path internally
-    export_orthomosaic(chunk, format='png', resolution=0.2)
-    export_orthomosaic(chunk, format='tif', resolution=0.04)
-    export_orthomosaic(chunk, format='png', resolution=0.3)
-    export_report(chunk)
-
-    print(f"Processing finished, results saved to {project_folder}.")
-    open_project_folder(project_folder)
+    print(f"Processing finished, results saved to {project_dir}.")
+    open_project_folder(project_dir)
     
     print("Step 2 workflow finished.")
     return 1      